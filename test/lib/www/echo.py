@@ -17,7 +17,7 @@ def handle_request(req):
         query=url.query,
         fragment=url.fragment,
         headers=headers,
-        postdata=req.postdata.decode('utf-8') if isinstance(req.postdata, bytes) else req.postdata,
+        postdata=req.postdata.decode('utf-8') if isinstance(req.postdata, (bytes, bytearray)) else req.postdata,
     )
 
     body = (json.dumps(d, indent=2) + '\n').encode('utf-8')
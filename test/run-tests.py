@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
-import argparse
-import collections
+import array
+import concurrent.futures
 import errno
-import glob
+import functools
 import importlib.util
+import io
+import itertools
 import os
-import platform
 import posixpath
 import re
+import select
+import selectors
 import shlex
 import socket
 import ssl
@@ -16,7 +19,7 @@ import subprocess
 import sys
 import threading
 import time
-import traceback
+import types
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -31,8 +34,34 @@ TESTS = [
     'regression/*.js',
 ]
 
+def compile_test_patterns(patterns):
+    """Compile glob PATTERNS into a single regex over paths relative to
+    the test directory.  Only '*' and '?' wildcards are supported; as
+    with glob they do not match '/', nor a leading '.'.  The pattern
+    that matched is identified by match.lastindex - 1."""
+    alts = []
+    for pattern in patterns:
+        parts = []
+        for part in pattern.split('/'):
+            rx = (re.escape(part)
+                  .replace(r'\*', '[^/]*')
+                  .replace(r'\?', '[^/]'))
+            if part[:1] in ('*', '?'):
+                rx = r'(?!\.)' + rx
+            parts.append(rx)
+        alts.append('(' + '/'.join(parts) + ')')
+    return re.compile('(?:' + '|'.join(alts) + r')\Z')
+
+TESTS_R = compile_test_patterns(TESTS)
+
 TIMEOUT = 7  # Maximum duration of PhantomJS execution (in seconds).
 
+# The test directory, and the PhantomJS binary under test.
+_BASE_PATH = os.path.normpath(os.path.dirname(os.path.abspath(__file__)))
+_PHANTOMJS_EXE = os.path.normpath(os.path.join(_BASE_PATH, '../bin/phantomjs'))
+if sys.platform in ('win32', 'cygwin'):
+    _PHANTOMJS_EXE += '.exe'
+
 _COLOR_NONE = {
     "_": "", "^": "",
     "r": "", "R": "",
@@ -61,17 +90,26 @@ _COLOR_BOLD = {
     "c": "\033[0m", "C": "\033[1m",
 }
 _COLORS = None
+_LABELS = None        # T code -> its label, colorized
+_SHORT_LABELS = None  # T code -> its short label, colorized
 
 def activate_colorization(options):
-    global _COLORS
+    global _COLORS, _LABELS, _SHORT_LABELS, colorize
+    _colorize_escapes.cache_clear()
     if options.color == "always":
         _COLORS = _COLOR_ON
     elif options.color == "never":
         _COLORS = _COLOR_NONE
     else:
-        if sys.stdout.isatty() and platform.system() != "Windows":
+        # Honor the NO_COLOR convention (https://no-color.org/), and ask
+        # terminfo directly rather than running tput.
+        term = os.environ.get("TERM", "")
+        if (sys.stdout.isatty() and sys.platform != "win32" and
+            term and term != "dumb" and not os.environ.get("NO_COLOR")):
             try:
-                n = int(subprocess.check_output(["tput", "colors"]))
+                import curses
+                curses.setupterm(term, sys.stdout.fileno())
+                n = curses.tigetnum("colors")
                 if n >= 8:
                     _COLORS = _COLOR_ON
                 else:
@@ -81,21 +119,43 @@ def activate_colorization(options):
         else:
             _COLORS = _COLOR_NONE
 
-def colorize(color, message):
+    if _COLORS is _COLOR_NONE:
+        colorize = _colorize_plain
+    else:
+        colorize = _colorize_escapes
+
+    _LABELS = [colorize(T.COLOR[code], T.LABEL[code]) for code in T.ALL]
+    _SHORT_LABELS = [colorize(T.COLOR[code], T.SHORT_LABEL[code])
+                     for code in T.ALL]
+
+# activate_colorization() points colorize at one of these.
+def _colorize_plain(color, message):
+    return message
+
+# Memoized; activate_colorization() clears the cache when _COLORS changes.
+@functools.lru_cache(maxsize=256)
+def _colorize_escapes(color, message):
     return _COLORS[color] + message + _COLORS["_"]
 
+colorize = _colorize_plain
+
 CIPHERLIST_2_7_9 = (
     'ECDH+AESGCM:DH+AESGCM:ECDH+AES256:DH+AES256:ECDH+AES128:DH+AES:ECDH+HIGH:'
     'DH+HIGH:ECDH+3DES:DH+3DES:RSA+AESGCM:RSA+AES:RSA+HIGH:RSA+3DES:!aNULL:'
     '!eNULL:!MD5:!DSS:!RC4'
 )
+@functools.lru_cache(maxsize=None)
+def server_ssl_context(crtfile, keyfile):
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(crtfile, keyfile)
+    return ctx
+
 def wrap_socket_ssl(sock, base_path):
     crtfile = os.path.join(base_path, 'lib/certs/https-snakeoil.crt')
     keyfile = os.path.join(base_path, 'lib/certs/https-snakeoil.key')
 
     try:
-        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        ctx.load_cert_chain(crtfile, keyfile)
+        ctx = server_ssl_context(crtfile, keyfile)
         return ctx.wrap_socket(sock, server_side=True)
     except AttributeError:
         return ssl.wrap_socket(sock,
@@ -113,42 +173,36 @@ class ResponseHookImporter(object):
             sys.modules['test_www'] = mod
             spec.loader.exec_module(mod)
         self.tr = str.maketrans('-./%', '____')
+        self.lock = threading.Lock()
 
     def __call__(self, path):
         modname = 'test_www.' + path.translate(self.tr)
         try:
             return sys.modules[modname]
         except KeyError:
-            spec = importlib.util.spec_from_file_location(modname, path)
-            mod = importlib.util.module_from_spec(spec)
-            sys.modules[modname] = mod
-            spec.loader.exec_module(mod)
-            return mod
+            # Concurrent requests for the same hook must not see a
+            # partially executed module.
+            with self.lock:
+                if modname in sys.modules:
+                    return sys.modules[modname]
+                spec = importlib.util.spec_from_file_location(modname, path)
+                mod = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(mod)
+                sys.modules[modname] = mod
+                return mod
 
 def do_call_subprocess(command, verbose, stdin_data, timeout):
-    def read_thread(linebuf, fp):
-        while True:
-            line = fp.readline()
-            if not line:
-                break
-            line = line.rstrip('\n')
-            if line:
-                linebuf.append(line)
-                if verbose >= 3:
-                    sys.stdout.write(line + '\n')
-
-    def write_thread(data, fp):
-        fp.writelines(data)
-        fp.close()
-
-    def reap_thread(proc, timed_out):
-        if proc.returncode is None:
-            proc.terminate()
-            timed_out[0] = True
-
-    class DummyThread:
-        def start(self): pass
-        def join(self):  pass
+    def add_lines(linebuf, data):
+        # DATA holds only complete lines, so it can be decoded in one go
+        # (no UTF-8 sequence contains a newline byte).  Line endings are
+        # then translated as in universal newlines mode.
+        text = data.decode('utf-8', 'replace')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        lines = [line for line in text.split('\n') if line]
+        linebuf.extend(lines)
+        if verbose >= 3 and lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
 
     if stdin_data:
         stdin = subprocess.PIPE
@@ -159,35 +213,89 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
                             stdin=stdin,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
-                            text=True)
-
-    if stdin_data:
-        sithrd = threading.Thread(target=write_thread,
-                                  args=(stdin_data, proc.stdin))
-    else:
-        sithrd = DummyThread()
+                            bufsize=0)
 
     stdout = []
     stderr = []
-    timed_out = [False]
-    sothrd = threading.Thread(target=read_thread, args=(stdout, proc.stdout))
-    sethrd = threading.Thread(target=read_thread, args=(stderr, proc.stderr))
-    rpthrd = threading.Timer(timeout, reap_thread, args=(proc, timed_out))
+    timed_out = False
+    deadline = time.monotonic() + timeout
 
-    sithrd.start()
-    sothrd.start()
-    sethrd.start()
-    rpthrd.start()
+    if sys.platform == 'win32':
+        # select() cannot wait on pipes on Windows.
+        stdin_buf = "".join(stdin_data).encode('utf-8') if stdin_data else None
+        try:
+            out, err = proc.communicate(stdin_buf, timeout)
+        except subprocess.TimeoutExpired:
+            proc.terminate()
+            out, err = proc.communicate()
+            timed_out = True
+        add_lines(stdout, out)
+        add_lines(stderr, err)
 
-    proc.wait()
-    if not timed_out[0]: rpthrd.cancel()
+    else:
+        # Multiplex all three pipes from this thread.  Partial lines are
+        # held in a per-pipe buffer until their newline arrives.
+        with selectors.DefaultSelector() as sel:
+            sel.register(proc.stdout, selectors.EVENT_READ,
+                         (stdout, bytearray()))
+            sel.register(proc.stderr, selectors.EVENT_READ,
+                         (stderr, bytearray()))
+            if stdin_data:
+                stdin_buf = memoryview("".join(stdin_data).encode('utf-8'))
+                sel.register(proc.stdin, selectors.EVENT_WRITE)
+
+            while sel.get_map():
+                if timed_out or deadline is None:
+                    ready = sel.select()
+                else:
+                    ready = sel.select(deadline - time.monotonic())
+                    if not ready and time.monotonic() >= deadline:
+                        # A child that has already exited has not timed
+                        # out, even if a grandchild still holds its pipes
+                        # open; just keep draining them.
+                        if proc.poll() is None:
+                            proc.terminate()
+                            timed_out = True
+                        else:
+                            deadline = None
+                        continue
 
-    sithrd.join()
-    sothrd.join()
-    sethrd.join()
-    rpthrd.join()
+                for key, _ in ready:
+                    if key.fileobj is proc.stdin:
+                        try:
+                            n = os.write(key.fd, stdin_buf[:select.PIPE_BUF])
+                        except BrokenPipeError:
+                            n = len(stdin_buf)
+                        stdin_buf = stdin_buf[n:]
+                        if not stdin_buf:
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                        continue
+
+                    linebuf, partial = key.data
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        partial += data
+                        nl = partial.rfind(b'\n')
+                        if nl != -1:
+                            add_lines(linebuf, partial[:nl])
+                            del partial[:nl+1]
+                    else:
+                        add_lines(linebuf, partial)
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
 
-    if timed_out[0]:
+        if timed_out or deadline is None:
+            proc.wait()
+        else:
+            try:
+                proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                proc.terminate()
+                proc.wait()
+                timed_out = True
+
+    if timed_out:
         stderr.append(f"TIMEOUT: Process terminated after {timeout} seconds.")
         if verbose >= 3:
             sys.stdout.write(stderr[-1] + "\n")
@@ -202,6 +310,23 @@ def do_call_subprocess(command, verbose, stdin_data, timeout):
     
 # --- Section 2: Handler factory, HTTP/HTTPS server classes (with bytes fix) ---
 
+@functools.lru_cache(maxsize=2048)
+def translate_www_path(www_path, path):
+    path = path.partition('?')[0].partition('#')[0]
+    path = urllib.parse.quote(urllib.parse.unquote(path)).lower()
+
+    trailing_slash = path.endswith('/')
+    path = posixpath.normpath(path)
+    while path.startswith('/'):
+        path = path[1:]
+    while path.startswith('../'):
+        path = path[3:]
+
+    path = os.path.normpath(os.path.join(www_path, *path.split('/')))
+    if trailing_slash:
+        path += '/'
+    return path
+
 def make_handler(www_path, verbose, get_response_hook):
     class CustomFileHandler(FileHandler):
         pass
@@ -216,22 +341,18 @@ class FileHandler(http.server.SimpleHTTPRequestHandler):
     get_response_hook = None
 
     def __init__(self, *args, **kwargs):
-        self._cached_untranslated_path = None
-        self._cached_translated_path = None
         self.postdata = None
         super().__init__(*args, **kwargs)
 
     def log_message(self, format, *args):
         if self.verbose >= 3:
-            sys.stdout.write("## " +
-                             ("HTTPS: " if getattr(self.server, 'is_ssl', False) else "HTTP: ") +
-                             (format % args) +
-                             "\n")
-            sys.stdout.flush()
+            sys.stdout.write(f"{self.server.log_prefix}{format % args}\n")
 
     def do_POST(self):
         try:
             ln = int(self.headers.get('content-length'))
+            if ln < 0:
+                raise ValueError(ln)
         except (TypeError, ValueError):
             self.send_response(400, 'Bad Request')
             self.send_header('Content-Type', 'text/plain')
@@ -241,19 +362,27 @@ class FileHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(msg.encode('utf-8'))
             return
 
-        self.postdata = self.rfile.read(ln)
+        # Read the body straight into its final buffer; response hooks
+        # accept any bytes-like postdata.
+        buf = bytearray(ln)
+        view = memoryview(buf)
+        off = 0
+        while off < ln:
+            n = self.rfile.readinto(view[off:])
+            if not n:
+                break
+            off += n
+        view.release()
+        del buf[off:]
+        self.postdata = buf
         self.do_GET()
 
     def send_head(self):
         path = self.translate_path(self.path)
 
         if self.verbose >= 3:
-            sys.stdout.write("## " +
-                             ("HTTPS: " if getattr(self.server, 'is_ssl', False) else "HTTP: ") +
-                             self.command + " " + self.path + " -> " +
-                             path +
-                             "\n")
-            sys.stdout.flush()
+            sys.stdout.write(f"{self.server.log_prefix}{self.command} "
+                             f"{self.path} -> {path}\n")
 
         # do not allow direct references to .py(c) files,
         # or indirect references to __init__.py
@@ -278,33 +407,7 @@ class FileHandler(http.server.SimpleHTTPRequestHandler):
         return None
 
     def translate_path(self, path):
-        if (self._cached_translated_path is not None and
-            self._cached_untranslated_path == path):
-            return self._cached_translated_path
-
-        orig_path = path
-
-        x = path.find('?')
-        if x != -1: path = path[:x]
-        x = path.find('#')
-        if x != -1: path = path[:x]
-
-        path = urllib.parse.quote(urllib.parse.unquote(path)).lower()
-
-        trailing_slash = path.endswith('/')
-        path = posixpath.normpath(path)
-        while path.startswith('/'):
-            path = path[1:]
-        while path.startswith('../'):
-            path = path[3:]
-
-        path = os.path.normpath(os.path.join(self.www_path, *path.split('/')))
-        if trailing_slash:
-            path += '/'
-
-        self._cached_untranslated_path = orig_path
-        self._cached_translated_path = path
-        return path
+        return translate_www_path(self.www_path, path)
 
 class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True
@@ -315,6 +418,7 @@ class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
             self.socket = wrap_socket_ssl(self.socket, base_path)
         self._signal_error = signal_error
         self.is_ssl = use_ssl
+        self.log_prefix = "## HTTPS: " if use_ssl else "## HTTP: "
 
     def handle_error(self, request, client_address):
         _, exval, _ = sys.exc_info()
@@ -330,13 +434,14 @@ class HTTPTestServer(object):
         self.www_path = os.path.join(base_path, 'lib/www')
         self.signal_error = signal_error
         self.verbose = verbose
-
-    def __enter__(self):
-        handler = make_handler(
+        self.handler = make_handler(
             self.www_path,
             self.verbose,
             ResponseHookImporter(self.www_path)
         )
+
+    def __enter__(self):
+        handler = self.handler
         self.httpd = TCPServer(False, handler, self.base_path, self.signal_error)
         os.environ['TEST_HTTP_BASE'] = \
             f'http://localhost:{self.httpd.server_address[1]}/'
@@ -365,49 +470,57 @@ class HTTPTestServer(object):
 
 # --- Section 3: Test Logic Classes (TestDetail, TestGroup, etc) ---
 
-class TestDetailCode(collections.namedtuple("TestDetailCode", (
-        "idx", "color", "short_label", "label", "long_label"))):
-    def __index__(self): return self.idx
-    def __hash__(self): return self.idx
-    def __eq__(self, other): return self.idx == other.idx
-    def __ne__(self, other): return self.idx != other.idx
-
 class T(object):
-    PASS  = TestDetailCode(0, "g", ".", "pass",  "passed")
-    FAIL  = TestDetailCode(1, "R", "F", "FAIL",  "failed")
-    XFAIL = TestDetailCode(2, "y", "f", "xfail", "failed as expected")
-    XPASS = TestDetailCode(3, "Y", "P", "XPASS", "passed unexpectedly")
-    ERROR = TestDetailCode(4, "R", "E", "ERROR", "had errors")
-    SKIP  = TestDetailCode(5, "m", "s", "skip",  "skipped")
+    # Test detail codes.  They are small integers, so that they can index
+    # counter arrays and the metadata tuples below directly.
+    PASS, FAIL, XFAIL, XPASS, ERROR, SKIP = range(6)
     MAX   = 6
+    ALL   = range(MAX)
+
+    COLOR       = ("g", "R", "y", "Y", "R", "m")
+    SHORT_LABEL = (".", "F", "f", "P", "E", "s")
+    LABEL       = ("pass", "FAIL", "xfail", "XPASS", "ERROR", "skip")
+    LONG_LABEL  = ("passed", "failed", "failed as expected",
+                   "passed unexpectedly", "had errors", "skipped")
+
+# The order in which the final summary lists each code, with its label.
+_REPORT_ORDER = tuple((code, T.LONG_LABEL[code])
+                      for code in (T.PASS, T.FAIL, T.XPASS,
+                                   T.XFAIL, T.ERROR, T.SKIP))
 
 class TestDetail(object):
     def __init__(self, message, test_id, detail_type):
         if not isinstance(message, list):
             message = [message]
-        self.message = [line.rstrip()
-                        for chunk in message
-                        for line in chunk.split("\n")]
+        # Most details are never printed, so splitting the message into
+        # lines is put off until it is needed.  The caller may reuse
+        # its list, hence the copy.
+        self._raw    = tuple(message)
         self.dtype   = detail_type
         self.test_id = test_id
 
+    @functools.cached_property
+    def message(self):
+        if not self._raw:
+            return []
+        return [line.rstrip() for line in "\n".join(self._raw).split("\n")]
+
     def report(self, fp):
-        col, label = self.dtype.color, self.dtype.label
+        label = _LABELS[self.dtype]
         if self.test_id:
-            fp.write("{:>5}: {}\n".format(colorize(col, label),
-                                          self.test_id))
+            fp.write(f"{label:>5}: {self.test_id}\n")
             lo = 0
         else:
-            fp.write("{:>5}: {}\n".format(colorize(col, label),
-                                          self.message[0]))
+            fp.write(f"{label:>5}: {self.message[0]}\n")
             lo = 1
+        start, end = _COLORS["b"], _COLORS["_"]
         for line in self.message[lo:]:
-            fp.write("  {}\n".format(colorize("b", line)))
+            fp.write(f"  {start}{line}{end}\n")
 
 class TestGroup(object):
     def __init__(self, name):
         self.name    = name
-        self.n       = [0]*T.MAX
+        self.n       = array.array('q', bytes(8 * T.MAX))
         self.details = []
 
     def parse(self, rc, out, err):
@@ -450,13 +563,12 @@ class TestGroup(object):
 
     def one_char_summary(self, fp):
         code = self.worst_code()
-        fp.write(colorize(code.color, code.short_label))
+        fp.write(_SHORT_LABELS[code])
         fp.flush()
 
     def line_summary(self, fp):
         code = self.worst_code()
-        fp.write("{}: {}\n".format(colorize("^", self.name),
-                                   colorize(code.color, code.label)))
+        fp.write(f"{colorize('^', self.name)}: {_LABELS[code]}\n")
 
     def report(self, fp, show_all):
         self.line_summary(fp)
@@ -469,12 +581,17 @@ class TestGroup(object):
             fp.write("\n")
 
     def report_for_verbose_level(self, fp, verbose):
+        # Assemble the whole report first, so it reaches FP in one write.
+        buf = io.StringIO()
         if verbose == 0:
-            self.one_char_summary(sys.stdout)
+            self.one_char_summary(buf)
         elif verbose == 1:
-            self.report(sys.stdout, False)
+            self.report(buf, False)
         else:
-            self.report(sys.stdout, True)
+            self.report(buf, True)
+        fp.write(buf.getvalue())
+        if verbose == 0:
+            fp.flush()
 
 class ExpectTestGroup(TestGroup):
     def __init__(self, name, rc_exp, stdout_exp, stderr_exp,
@@ -510,15 +627,10 @@ class ExpectTestGroup(TestGroup):
 
     def parse_output(self, what, exp, got, xfail):
         diff = []
-        le = len(exp)
-        lg = len(got)
-        for i in range(max(le, lg)):
-            e = ""
-            g = ""
-            if i < le: e = exp[i]
-            if i < lg: g = got[i]
+        lines = itertools.zip_longest(exp, got, fillvalue="")
+        for i, (e, g) in enumerate(lines, start=1):
             if e != g:
-                diff.extend(("{}: line {} not as expected".format(what, i+1),
+                diff.extend((f"{what}: line {i} not as expected",
                              "-" + repr(e)[1:-1],
                              "+" + repr(g)[1:-1]))
 
@@ -538,9 +650,21 @@ class ExpectTestGroup(TestGroup):
 class TAPTestGroup(TestGroup):
     diag_r = re.compile(r"^#(#*)\s*(.*)$")
     plan_r = re.compile(r"^1..(\d+)(?:\s*\#\s*SKIP(?::\s*(.*)))?$")
-    test_r = re.compile(r"^(not ok|ok)\s*"
+    # Either a diagnostic (as diag_r) or a test point, so that each line
+    # after the plan needs only one match.  Group 3 is None for a
+    # diagnostic.
+    line_r = re.compile(r"^(?:#(#*)\s*(.*)|"
+                        r"(not ok|ok)\s*"
                         r"([0-9]+)?\s*"
-                        r"([^#]*)(?:# (TODO|SKIP))?$")
+                        r"([^#]*)(?:# (TODO|SKIP))?)$")
+    # (status, directive) -> result code, for every valid combination.
+    point_codes = {
+        ("ok", None):       T.PASS,
+        ("ok", "TODO"):     T.XPASS,
+        ("ok", "SKIP"):     T.SKIP,
+        ("not ok", None):   T.FAIL,
+        ("not ok", "TODO"): T.XFAIL,
+    }
 
     def parse(self, rc, out, err):
         self.parse_tap(out, err)
@@ -549,16 +673,20 @@ class TAPTestGroup(TestGroup):
     def parse_tap(self, out, err):
         points_already_used = set()
         messages = []
+        diag_match = self.diag_r.match
+        plan_match = self.plan_r.match
+        line_match = self.line_r.match
+        point_codes = self.point_codes
 
         for i in range(len(out)):
             line = out[i]
-            m = self.diag_r.match(line)
+            m = diag_match(line)
             if m:
                 if not m.group(1):
                     messages.append(m.group(2))
                 continue
 
-            m = self.plan_r.match(line)
+            m = plan_match(line)
             if m:
                 break
 
@@ -572,8 +700,9 @@ class TAPTestGroup(TestGroup):
             return
 
         max_point = int(m.group(1))
+        had_error = any(msg.startswith("ERROR:") for msg in messages)
         if max_point == 0:
-            if any(msg.startswith("ERROR:") for msg in messages):
+            if had_error:
                 self.add_error(messages, m.group(2) or "Test group skipped")
             else:
                 self.add_skip(messages, m.group(2) or "Test group skipped")
@@ -581,7 +710,7 @@ class TAPTestGroup(TestGroup):
                 self.add_skip(out[(i+1):], "All further output ignored")
             return
 
-        if any(msg.startswith("ERROR:") for msg in messages):
+        if had_error:
             self.add_error(messages, "Before tests")
             messages = []
         elif messages:
@@ -592,17 +721,16 @@ class TAPTestGroup(TestGroup):
 
         for i in range(i+1, len(out)):
             line = out[i]
-            m = self.diag_r.match(line)
-            if m:
+            m = line_match(line)
+            if m and m.group(3) is None:
                 if not m.group(1):
                     messages.append(m.group(2))
                 continue
-            m = self.test_r.match(line)
             if m:
-                status = m.group(1)
-                point  = m.group(2)
-                desc   = m.group(3)
-                dirv   = m.group(4)
+                status = m.group(3)
+                point  = m.group(4)
+                desc   = m.group(5)
+                dirv   = m.group(6)
 
                 if point:
                     point = int(point)
@@ -616,24 +744,12 @@ class TAPTestGroup(TestGroup):
                     if point > max_point:
                         status = "not ok"
 
-                    if status == "ok":
-                        if not dirv:
-                            self.add_pass(messages, desc)
-                        elif dirv == "TODO":
-                            self.add_xpass(messages, desc)
-                        elif dirv == "SKIP":
-                            self.add_skip(messages, desc)
-                        else:
-                            self.add_error(messages, desc +
-                                " [ok, with invalid directive "+dirv+"]")
+                    code = point_codes.get((status, dirv))
+                    if code is not None:
+                        self._add_d(messages, desc, code)
                     else:
-                        if not dirv:
-                            self.add_fail(messages, desc)
-                        elif dirv == "TODO":
-                            self.add_xfail(messages, desc)
-                        else:
-                            self.add_error(messages, desc +
-                                " [not ok, with invalid directive "+dirv+"]")
+                        self.add_error(messages, desc + " [" + status +
+                            ", with invalid directive "+dirv+"]")
                 del messages[:]
                 prev_point = point
             else:
@@ -652,16 +768,63 @@ class TAPTestGroup(TestGroup):
 
 # --- Section 4: TestRunner and main entrypoint ---
 
+# The quoting characters only shlex understands, newlines (which end a
+# comment), and characters str.split() treats as whitespace but shlex
+# does not.
+_DIRECTIVE_SHLEX_R = re.compile(r"[\"'\\\n\x0b\x0c\x1c-\x1f]")
+_DIRECTIVE_SEP_R   = re.compile(r"[ \t\r\n]+")
+
+def split_directive(text):
+    """Split the text of a directive into tokens, as shlex would.  Most
+    directives are plain ASCII with no quoting, so shlex is only needed
+    when a quote, a backslash, or unusual whitespace is present."""
+    if not text.isascii() or _DIRECTIVE_SHLEX_R.search(text):
+        return shlex.split(text, comments=True)
+    return [tok for tok in _DIRECTIVE_SEP_R.split(text.partition('#')[0])
+            if tok]
+
+def read_directive_lines(script, blocksize=4096):
+    """Yield the //! directive lines at the top of SCRIPT.  Only as much
+    of the file as the directives occupy (rounded up to BLOCKSIZE) is
+    read; the rest of the script is never looked at."""
+    with open(script, "rb") as s:
+        partial = b""
+        while True:
+            block = s.read(blocksize)
+            lines = (partial + block).split(b"\n")
+            if block:
+                partial = lines.pop()
+            for line in lines:
+                if not line.startswith(b"//!"):
+                    return
+                yield line.decode("utf-8")
+            if not block:
+                return
+
 class TestRunner(object):
     def __init__(self, base_path, phantomjs_exe, options):
         self.base_path       = base_path
         self.cert_path       = os.path.join(base_path, 'lib/certs')
         self.harness         = os.path.join(base_path, 'lib/testharness.js')
+        self.snakeoil_arg    = '--ssl-certificates-path=' + self.cert_path
         self.phantomjs_exe   = phantomjs_exe
         self.verbose         = options.verbose
         self.debugger        = options.debugger
         self.to_run          = options.to_run
+        self.jobs            = options.jobs
         self.server_errs     = []
+        self.server_errs_lock = threading.Lock()
+        # POSIX subprocess encodes every str argument before exec; do it
+        # once for the binary, which appears in every command line.
+        # Windows wants str.
+        if sys.platform == 'win32':
+            self.phantomjs_arg = phantomjs_exe
+        else:
+            self.phantomjs_arg = os.fsencode(phantomjs_exe)
+        # The start of every command line run without a debugger.  Debugger
+        # runs build theirs per call, so that an unknown debugger is
+        # reported from run_tests(), like any other failure.
+        self.plain_command   = tuple(self.get_base_command(None))
         self.prepare_environ()
 
     def prepare_environ(self):
@@ -675,17 +838,18 @@ class TestRunner(object):
         os.environ["TZ"] = "CIST-12:45:00"
 
     def signal_server_error(self, exc_info):
-        self.server_errs.append(exc_info)
+        with self.server_errs_lock:
+            self.server_errs.append(exc_info)
 
     def get_base_command(self, debugger):
         if debugger is None:
-            return [self.phantomjs_exe]
+            return [self.phantomjs_arg]
         elif debugger == "gdb":
-            return ["gdb", "--args", self.phantomjs_exe]
+            return ["gdb", "--args", self.phantomjs_arg]
         elif debugger == "lldb":
-            return ["lldb", "--", self.phantomjs_exe]
+            return ["lldb", "--", self.phantomjs_arg]
         elif debugger == "valgrind":
-            return ["valgrind", self.phantomjs_exe]
+            return ["valgrind", self.phantomjs_arg]
         else:
             raise RuntimeError("Don't know how to invoke " + self.debugger)
 
@@ -698,16 +862,17 @@ class TestRunner(object):
             verbose = False
             debugger = None
 
-        output = []
-        command = self.get_base_command(debugger)
-        command.extend(pjs_args)
-        command.append(script)
-        if verbose:
-            command.append('--verbose={}'.format(verbose))
-        command.extend(script_args)
+        if debugger:
+            base_command = self.get_base_command(debugger)
+        else:
+            base_command = self.plain_command
+        verbose_args = [f'--verbose={verbose}'] if verbose else []
+        command = [*base_command, *pjs_args,
+                   script, *verbose_args, *script_args]
 
         if verbose >= 3:
-            sys.stdout.write("## running {}\n".format(" ".join(command)))
+            sys.stdout.write("## running {}\n".format(
+                " ".join(map(os.fsdecode, command))))
 
         if debugger:
             subprocess.call(command)
@@ -736,60 +901,57 @@ class TestRunner(object):
         if self.verbose >= 3:
             sys.stdout.write(colorize("^", name) + ":\n")
         try:
-            with open(script, "rt") as s:
-                for line in s:
-                    if not line.startswith("//!"):
+            for line in read_directive_lines(script):
+                tokens = split_directive(line[3:])
+
+                skip = False
+                for i in range(len(tokens)):
+                    if skip:
+                        skip = False
+                        continue
+                    tok = tokens[i]
+                    if tok == "no-harness":
+                        use_harness = False
+                    elif tok == "no-snakeoil":
+                        use_snakeoil = False
+                    elif tok == "expect-exit-fails":
+                        rc_xfail = True
+                    elif tok == "expect-stdout-fails":
+                        stdout_xfail = True
+                    elif tok == "expect-stderr-fails":
+                        stderr_xfail = True
+                    elif tok == "timeout:":
+                        require_args(tok, i, tokens)
+                        timeout = float(tokens[i+1])
+                        if timeout <= 0:
+                            raise ValueError("timeout must be positive")
+                        skip = True
+                    elif tok == "expect-exit:":
+                        require_args(tok, i, tokens)
+                        rc_exp = int(tokens[i+1])
+                        skip = True
+                    elif tok == "phantomjs:":
+                        require_args(tok, i, tokens)
+                        pjs_args.extend(tokens[(i+1):])
                         break
-                    tokens = shlex.split(line[3:], comments=True)
-
-                    skip = False
-                    for i in range(len(tokens)):
-                        if skip:
-                            skip = False
-                            continue
-                        tok = tokens[i]
-                        if tok == "no-harness":
-                            use_harness = False
-                        elif tok == "no-snakeoil":
-                            use_snakeoil = False
-                        elif tok == "expect-exit-fails":
-                            rc_xfail = True
-                        elif tok == "expect-stdout-fails":
-                            stdout_xfail = True
-                        elif tok == "expect-stderr-fails":
-                            stderr_xfail = True
-                        elif tok == "timeout:":
-                            require_args(tok, i, tokens)
-                            timeout = float(tokens[i+1])
-                            if timeout <= 0:
-                                raise ValueError("timeout must be positive")
-                            skip = True
-                        elif tok == "expect-exit:":
-                            require_args(tok, i, tokens)
-                            rc_exp = int(tokens[i+1])
-                            skip = True
-                        elif tok == "phantomjs:":
-                            require_args(tok, i, tokens)
-                            pjs_args.extend(tokens[(i+1):])
-                            break
-                        elif tok == "script:":
-                            require_args(tok, i, tokens)
-                            script_args.extend(tokens[(i+1):])
-                            break
-                        elif tok == "stdin:":
-                            require_args(tok, i, tokens)
-                            stdin_data.append(" ".join(tokens[(i+1):]) + "\n")
-                            break
-                        elif tok == "expect-stdout:":
-                            require_args(tok, i, tokens)
-                            stdout_exp.append(" ".join(tokens[(i+1):]))
-                            break
-                        elif tok == "expect-stderr:":
-                            require_args(tok, i, tokens)
-                            stderr_exp.append(" ".join(tokens[(i+1):]))
-                            break
-                        else:
-                            raise ValueError("unrecognized directive: " + tok)
+                    elif tok == "script:":
+                        require_args(tok, i, tokens)
+                        script_args.extend(tokens[(i+1):])
+                        break
+                    elif tok == "stdin:":
+                        require_args(tok, i, tokens)
+                        stdin_data.append(" ".join(tokens[(i+1):]) + "\n")
+                        break
+                    elif tok == "expect-stdout:":
+                        require_args(tok, i, tokens)
+                        stdout_exp.append(" ".join(tokens[(i+1):]))
+                        break
+                    elif tok == "expect-stderr:":
+                        require_args(tok, i, tokens)
+                        stderr_exp.append(" ".join(tokens[(i+1):]))
+                        break
+                    else:
+                        raise ValueError("unrecognized directive: " + tok)
 
         except Exception as e:
             grp = TestGroup(name)
@@ -802,11 +964,11 @@ class TestRunner(object):
             return grp
 
         if use_harness:
-            script_args.insert(0, script)
+            script_args = [script, *script_args]
             script = self.harness
 
         if use_snakeoil:
-            pjs_args.insert(0, '--ssl-certificates-path=' + self.cert_path)
+            pjs_args = [self.snakeoil_arg, *pjs_args]
 
         rc, out, err = self.run_phantomjs(script, script_args, pjs_args,
                                           stdin_data, timeout)
@@ -820,17 +982,38 @@ class TestRunner(object):
         grp.parse(rc, out, err)
         return grp
 
-    def run_tests(self):
-        start = time.time()
+    def collect_tests(self):
         base = self.base_path
         nlen = len(base) + 1
 
-        results = []
-
-        for test_glob in TESTS:
-            test_glob = os.path.join(base, test_glob)
+        # A single scan of the test directories classifies every file
+        # against all of TESTS at once.  Matches are grouped by pattern
+        # and sorted, which gives the same order as globbing each
+        # pattern in turn.  The first component of each pattern must
+        # be a plain directory name.
+        found = [[] for _ in TESTS]
+        max_depth = max(pattern.count('/') for pattern in TESTS)
+        pending = [(os.path.join(base, top), top, 1)
+                   for top in {pattern.split('/')[0] for pattern in TESTS}]
+        while pending:
+            path, rel, depth = pending.pop()
+            try:
+                entries = list(os.scandir(path))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                erel = rel + '/' + entry.name
+                if entry.is_dir():
+                    if depth < max_depth:
+                        pending.append((entry.path, erel, depth + 1))
+                else:
+                    m = TESTS_R.match(erel)
+                    if m:
+                        found[m.lastindex - 1].append(entry.path)
 
-            for test_script in sorted(glob.glob(test_glob)):
+        tests = []
+        for scripts in found:
+            for test_script in sorted(scripts):
                 tname = os.path.splitext(test_script)[0][nlen:]
                 if self.to_run:
                     for to_run in self.to_run:
@@ -838,19 +1021,53 @@ class TestRunner(object):
                             break
                     else:
                         continue
+                tests.append((test_script, tname))
+        return tests
 
+    def run_tests(self):
+        start = time.time()
+        tests = self.collect_tests()
+        stdout = sys.stdout
+
+        # Each test is an independent PhantomJS process, so with -j they
+        # can run concurrently.  Under a debugger, or when tracing, the
+        # output would be unusable unless they run one at a time, on this
+        # thread.
+        results = []
+        if self.jobs == 1 or self.debugger or self.verbose >= 3:
+            for test_script, tname in tests:
                 grp = self.run_test(test_script, tname)
-                grp.report_for_verbose_level(sys.stdout, self.verbose)
+                grp.report_for_verbose_level(stdout, self.verbose)
                 results.append(grp)
-
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.jobs) as ex:
+                futures = [ex.submit(self.run_test, test_script, tname)
+                           for test_script, tname in tests]
+                try:
+                    # Report in submission order, so the output does not
+                    # depend on which tests happen to finish first.
+                    for fut in futures:
+                        grp = fut.result()
+                        grp.report_for_verbose_level(stdout, self.verbose)
+                        results.append(grp)
+                except BaseException:
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+
+        # The servers are still running, so work from a snapshot.
         grp = TestGroup("HTTP server errors")
-        for ty, val, tb in self.server_errs:
-            grp.add_error(traceback.format_tb(tb, 5),
-                          traceback.format_exception_only(ty, val)[-1])
-        grp.report_for_verbose_level(sys.stdout, self.verbose)
+        with self.server_errs_lock:
+            errs = list(self.server_errs)
+        if errs:
+            import traceback
+            for ty, val, tb in errs:
+                grp.add_error(traceback.format_tb(tb, 5),
+                              traceback.format_exception_only(ty, val)[-1])
+        grp.report_for_verbose_level(stdout, self.verbose)
         results.append(grp)
 
-        sys.stdout.write("\n")
+        stdout.write("\n")
         return self.report(results, time.time() - start)
 
     def report(self, results, elapsed):
@@ -858,32 +1075,37 @@ class TestRunner(object):
             sys.stderr.write("No tests selected for execution.\n")
             return 1
 
-        n = [0] * T.MAX
-
+        # The failure reports and the summary go out in one write.
+        buf = io.StringIO()
         for grp in results:
             if self.verbose == 0 and not grp.is_successful():
-                grp.report(sys.stdout, False)
-            for i, x in enumerate(grp.n): n[i] += x
+                grp.report(buf, False)
 
-        sys.stdout.write("{:6.3f}s elapsed\n".format(elapsed))
-        for s in (T.PASS, T.FAIL, T.XPASS, T.XFAIL, T.ERROR, T.SKIP):
-            if n[s]:
-                sys.stdout.write(" {:>4} {}\n".format(n[s], s.long_label))
+        # Total the counters of all groups in a single pass per code.
+        n = [sum(counts) for counts in zip(*(grp.n for grp in results))]
 
-        if n[T.FAIL] == 0 and n[T.XPASS] == 0 and n[T.ERROR] == 0:
-            return 0
-        else:
-            return 1
+        buf.write(f"{elapsed:6.3f}s elapsed\n")
+        for code, label in _REPORT_ORDER:
+            if n[code]:
+                buf.write(f" {n[code]:>4} {label}\n")
+        sys.stdout.write(buf.getvalue())
+        sys.stdout.flush()
 
-def init():
-    base_path = os.path.normpath(os.path.dirname(os.path.abspath(__file__)))
-    phantomjs_exe = os.path.normpath(os.path.join(base_path, '../bin/phantomjs'))
-    if sys.platform in ('win32', 'cygwin'):
-        phantomjs_exe += '.exe'
-    if not os.path.isfile(phantomjs_exe):
-        sys.stdout.write(f"{phantomjs_exe} is unavailable, cannot run tests.\n")
-        sys.exit(1)
+        return 1 if n[T.FAIL] | n[T.XPASS] | n[T.ERROR] else 0
 
+def positive_int(value):
+    import argparse
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer")
+    return n
+
+@functools.lru_cache(maxsize=1)
+def make_arg_parser():
+    import argparse
     parser = argparse.ArgumentParser(description='Run PhantomJS tests.')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Increase verbosity of logs (repeat for more)')
@@ -891,41 +1113,113 @@ def init():
                         help='tests to run (default: all of them)')
     parser.add_argument('--debugger', default=None,
                         help="Run PhantomJS under DEBUGGER")
+    parser.add_argument('-j', '--jobs', metavar='N', type=positive_int,
+                        default=1,
+                        help="run up to N tests at once (default: 1)")
     parser.add_argument('--color', metavar="WHEN", default='auto',
                         choices=['always', 'never', 'auto'],
                         help="colorize the output; can be 'always',"
                         " 'never', or 'auto' (the default)")
+    return parser
+
+def parse_args_fast(argv):
+    """Parse the usual command lines (options first, then test names)
+    without argparse.  Returns None for anything else, including --help
+    and invalid usage, which make_arg_parser() then handles."""
+    options = types.SimpleNamespace(verbose=0, to_run=[], debugger=None,
+                                    color='auto', jobs=1)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg[:1] != '-' or arg == '-':
+            break
+        name, eq, value = arg.partition('=')
+        if arg == '--verbose':
+            options.verbose += 1
+        elif arg.strip('v') == '-':  # -v, -vv, ...
+            options.verbose += len(arg) - 1
+        elif name in ('--debugger', '--color', '--jobs'):
+            if not eq:
+                i += 1
+                if i == len(argv) or argv[i][:1] == '-':
+                    return None
+                value = argv[i]
+            if name == '--debugger':
+                options.debugger = value
+            elif name == '--jobs':
+                if not value.isdecimal() or int(value) < 1:
+                    return None
+                options.jobs = int(value)
+            elif value in ('always', 'never', 'auto'):
+                options.color = value
+            else:
+                return None
+        else:
+            return None
+        i += 1
+
+    for arg in argv[i:]:
+        if arg[:1] == '-' and arg != '-':
+            return None
+    options.to_run = argv[i:]
+    return options
+
+def init(argv=None):
+    base_path = _BASE_PATH
+    phantomjs_exe = _PHANTOMJS_EXE
+    if not os.path.isfile(phantomjs_exe):
+        sys.stdout.write(f"{phantomjs_exe} is unavailable, cannot run tests.\n")
+        sys.exit(1)
 
-    options = parser.parse_args()
+    if argv is None:
+        argv = sys.argv[1:]
+    options = parse_args_fast(argv)
+    if options is None:
+        options = make_arg_parser().parse_args(argv)
     activate_colorization(options)
     runner = TestRunner(base_path, phantomjs_exe, options)
-    if options.verbose:
-        rc, ver, err = runner.run_phantomjs('--version', silent=True)
-        if rc != 0 or len(ver) != 1 or len(err) != 0:
-            sys.stdout.write(colorize("R", "FATAL")+": Version check failed\n")
-            for l in ver:
-                sys.stdout.write(colorize("b", "## " + l) + "\n")
-            for l in err:
-                sys.stdout.write(colorize("b", "## " + l) + "\n")
-            sys.stdout.write(colorize("b", f"## exit {rc}") + "\n")
-            sys.exit(1)
 
-        sys.stdout.write(colorize("b", f"## Testing PhantomJS {ver[0]}")+"\n")
+    # The version check runs in the background, overlapping with the
+    # HTTP server startup in main(); see check_version().
+    version_check = None
+    if options.verbose:
+        ex = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        version_check = ex.submit(runner.run_phantomjs, '--version',
+                                  silent=True)
+        ex.shutdown(wait=False)
+
+    return runner, version_check
+
+def check_version(version_check):
+    rc, ver, err = version_check.result()
+    out = sys.stdout.write
+    if rc or err or len(ver) != 1:
+        out(colorize("R", "FATAL")+": Version check failed\n")
+        for l in ver:
+            out(colorize("b", "## " + l) + "\n")
+        for l in err:
+            out(colorize("b", "## " + l) + "\n")
+        out(colorize("b", f"## exit {rc}") + "\n")
+        sys.exit(1)
 
-    return runner
+    out(colorize("b", f"## Testing PhantomJS {ver[0]}")+"\n")
 
 def main():
-    runner = init()
+    runner, version_check = init()
     try:
         with HTTPTestServer(runner.base_path,
                             runner.signal_server_error,
                             runner.verbose):
+            if version_check is not None:
+                check_version(version_check)
             sys.exit(runner.run_tests())
     except Exception:
-        trace = traceback.format_exc(5).split("\n")
-        sys.stdout.write(colorize("R", "FATAL") + ": " + trace[-2] + "\n")
-        for line in trace[:-2]:
-            sys.stdout.write(colorize("b", "## " + line) + "\n")
+        import traceback
+        trace = traceback.format_exc(5).splitlines()
+        start, end = _COLORS["b"], _COLORS["_"]
+        sys.stdout.write(colorize("R", "FATAL") + ": " + trace[-1] + "\n" +
+                         "".join(f"{start}## {line}{end}\n"
+                                 for line in trace[:-1]))
         sys.exit(1)
     except KeyboardInterrupt:
         sys.exit(2)